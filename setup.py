@@ -98,6 +98,7 @@ setup(name='zope.app.testing',
           # We need zope.component with the hooks module.
           'zope.component >= 3.8',
           'zope.container',
+          'zope.event',
           'zope.i18n >= 4.3.0',
           'zope.interface',
           'zope.password',
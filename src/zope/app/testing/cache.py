@@ -0,0 +1,404 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""On-disk caches for functional test layers.
+
+Base storage snapshots store the committed contents of the databases of
+a layer after bootstrap and the layer fixtures, so that later runs don't
+have to bootstrap the databases or build the fixtures again.  They are
+keyed by the fixtures, by a manifest holding a content hash of every
+ZCML file and Python module the configuration of the layer was built
+from, and by the code bootstrapping the databases.  The names of the
+modules imported while parsing a configuration are recorded as well,
+since processes that imported them before don't see them being imported.
+
+"""
+
+import functools
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+
+import zope.app.appsetup.appsetup
+import zope.component
+import zope.component.hooks
+from zope.app.appsetup.appsetup import SystemConfigurationParticipation
+from zope.app.appsetup.interfaces import IDatabaseOpenedEvent
+from zope.app.appsetup.interfaces import IDatabaseOpenedWithRootEvent
+from zope.interface.interface import InterfaceClass
+from zope.security.management import endInteraction
+from zope.security.management import newInteraction
+
+
+try:
+    from zope.generations.interfaces import ISchemaManager
+except ImportError:  # pragma: no cover
+    ISchemaManager = None
+
+
+# Cache files not used for this many seconds are removed.
+MAX_AGE = 30 * 24 * 60 * 60
+
+
+def hashFile(path):
+    """Return the hex SHA-256 digest of the file at `path`."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def makeKey(*parts):
+    """Return a hex digest identifying the given string parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def makeManifest(paths):
+    """Return a mapping from each existing path to its content hash."""
+    manifest = {}
+    for path in sorted(set(paths)):
+        if os.path.isfile(path):
+            manifest[path] = hashFile(path)
+    return manifest
+
+
+def manifestDigest(manifest):
+    """Return a single digest summarizing a manifest."""
+    return makeKey(sorted(manifest.items()))
+
+
+def _moduleFile(module):
+    path = getattr(module, '__file__', None)
+    if path and path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    return path
+
+
+def _objectModules(ob):
+    # The modules defining a class, interface or function, as well as the
+    # bases of the class or interface.
+    if isinstance(ob, type):
+        return {cls.__module__ for cls in ob.__mro__}
+    if isinstance(ob, InterfaceClass):
+        return {iface.__module__ for iface in ob.__iro__}
+    if isinstance(ob, (types.FunctionType, types.MethodType)):
+        return {getattr(ob, '__module__', None)}
+    return set()
+
+
+def _actionModules(actions):
+    # The modules defining the callables and the classes, interfaces or
+    # functions passed to the actions.
+    names = set()
+    for action in actions:
+        for ob in ((action['callable'],) + tuple(action['args'])
+                   + tuple(action['kw'].values())):
+            if isinstance(ob, (list, tuple)):
+                candidates = ob
+            else:
+                candidates = (ob,)
+            for candidate in candidates:
+                names |= _objectModules(candidate)
+    return names
+
+
+def _packageFiles(package_name):
+    # The Python modules of a package, without importing it.
+    try:
+        spec = importlib.util.find_spec(package_name)
+    except (ImportError, ValueError):
+        return set()
+    files = set()
+    for directory in getattr(spec, 'submodule_search_locations', None) or ():
+        files.update(glob.glob(os.path.join(directory, '*.py')))
+    return files
+
+
+def _finishConfiguration(context, config_file):
+    # Do what zope.app.appsetup.appsetup.config does after parsing.
+    newInteraction(SystemConfigurationParticipation())
+    try:
+        zope.component.hooks.setHooks()
+        context.execute_actions()
+    finally:
+        endInteraction()
+    appsetup = zope.app.appsetup.appsetup
+    appsetup._configured = True
+    setattr(appsetup, '__config_source', config_file)
+    setattr(appsetup, '__config_context', context)
+
+
+def importedModulesPath(cache_dir, config_file):
+    """Return the path of the file recording the modules imported while
+    parsing the configuration file.
+    """
+    key = makeKey(os.path.abspath(config_file))
+    return os.path.join(cache_dir, f'zcml-{key}.json')
+
+
+def _importedModules(path, modules):
+    # The modules imported while parsing the configuration in this or an
+    # earlier run.  Processes that imported some of them before parsing
+    # still find them here, so that they compute the same manifest.
+    try:
+        with open(path) as f:
+            recorded = set(json.load(f))
+    except (OSError, ValueError):
+        recorded = set()
+    if modules <= recorded:
+        _touch(path)
+        return recorded
+    modules = sorted(recorded | modules)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(modules, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return set(modules)
+
+
+def config(config_file, cache_dir):
+    """Execute the ZCML configuration file and identify what it is made of.
+
+    Returns a digest of the manifest of the ZCML files and Python modules
+    the configuration was built from, or None if the configuration had
+    already been executed.  The names of the modules imported while
+    parsing are recorded in `cache_dir`.
+    """
+    if zope.app.appsetup.appsetup._configured:
+        # Already configured; appsetup.config would do nothing either.
+        return None
+
+    # The actions are executed after collecting the modules they refer to.
+    before = set(sys.modules)
+    context = zope.app.appsetup.appsetup.config(config_file, execute=False)
+    actions = list(context.actions)
+    modules = _importedModules(importedModulesPath(cache_dir, config_file),
+                               set(sys.modules) - before)
+    modules |= _actionModules(actions)
+    files = set(context._seen_files)
+    files.add(os.path.abspath(config_file))
+    # The Python modules of the packages containing the ZCML files, those
+    # imported while parsing and those defining the objects the actions
+    # refer to.
+    for directory in {os.path.dirname(path) for path in files}:
+        files.update(glob.glob(os.path.join(directory, '*.py')))
+    for name in modules:
+        module_file = _moduleFile(sys.modules.get(name))
+        if module_file:
+            files.add(module_file)
+    manifest = makeManifest(files)
+    _finishConfiguration(context, config_file)
+    return manifestDigest(manifest)
+
+
+def bootstrapDigest():
+    """Return a digest of the code filling the databases when they are opened.
+
+    That is the modules of the subscribers to IDatabaseOpenedEvent and
+    IDatabaseOpenedWithRootEvent and, if zope.generations is installed,
+    of the schema managers and the packages of their evolve scripts.
+    Subscribers and schema managers are often registered as instances or
+    live in modules no ZCML file refers to, so that the manifest of the
+    configuration misses them.
+    """
+    registry = zope.component.getGlobalSiteManager()
+    names = set()
+    files = set()
+    events = (IDatabaseOpenedEvent, IDatabaseOpenedWithRootEvent)
+    for registration in registry.registeredHandlers():
+        required = registration.required
+        if len(required) == 1 and any(event.isOrExtends(required[0])
+                                      for event in events):
+            handler = registration.handler
+            names |= _objectModules(handler) or _objectModules(type(handler))
+    if ISchemaManager is not None:
+        for name, manager in registry.getUtilitiesFor(ISchemaManager):
+            names |= _objectModules(type(manager))
+            package_name = getattr(manager, 'package_name', None)
+            if package_name:
+                files |= _packageFiles(package_name)
+    for name in names:
+        module_file = _moduleFile(sys.modules.get(name))
+        if module_file:
+            files.add(module_file)
+    return manifestDigest(makeManifest(files))
+
+
+def fixtureIdentity(fixture):
+    """Return a value identifying a layer fixture and its code.
+
+    It consists of the dotted name of the fixture and the content hash of
+    the module defining it, so that snapshots built with the fixture are
+    invalidated when it changes.  Partials, methods and callable instances
+    are identified by their function or class and their arguments or
+    state, which must consist of plain values, callables and instances
+    identified by their state.
+    """
+    digests = []
+    name = _callableIdentity(fixture, digests)
+    return (name, tuple(digests))
+
+
+def _callableIdentity(ob, digests):
+    if isinstance(ob, functools.partial):
+        return ('partial', _callableIdentity(ob.func, digests),
+                _valueIdentity(ob.args, digests),
+                _valueIdentity(ob.keywords, digests))
+    if isinstance(ob, types.MethodType):
+        return ('method', _callableIdentity(ob.__func__, digests),
+                _valueIdentity(ob.__self__, digests))
+    if not isinstance(ob, (type, types.FunctionType)):
+        return _instanceIdentity(ob, digests)
+    module = ob.__module__
+    path = _moduleFile(sys.modules.get(module))
+    digests.append(hashFile(path) if path and os.path.isfile(path) else None)
+    return f'{module}.{ob.__qualname__}'
+
+
+def _instanceIdentity(ob, digests):
+    state = getattr(ob, '__dict__', None)
+    if not isinstance(state, dict):
+        raise ValueError(f"Can't identify {ob!r} by its state")
+    return ('instance', _callableIdentity(type(ob), digests),
+            _valueIdentity(state, digests))
+
+
+def _valueIdentity(value, digests):
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return value
+    if isinstance(value, (tuple, list)):
+        return tuple(_valueIdentity(item, digests) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((repr(key), _valueIdentity(item, digests))
+                            for key, item in value.items()))
+    if callable(value):
+        return _callableIdentity(value, digests)
+    if type(value).__repr__ is object.__repr__:
+        # Which contains the address of the object
+        return _instanceIdentity(value, digests)
+    return (_callableIdentity(type(value), digests), repr(value))
+
+
+def snapshotPath(cache_dir, layer, key, name):
+    """Return the path of the base storage snapshot for database `name`.
+
+    `layer` identifies the layer and `key` what the snapshot was built
+    from, so that `pruneSnapshots` can find the outdated snapshots of the
+    layer.
+    """
+    return os.path.join(
+        cache_dir,
+        f'storage-{layer[:16]}-{makeKey(name)[:16]}-{key}.fs')
+
+
+def pruneSnapshots(path):
+    """Remove the other snapshots of the layer and database of `path`."""
+    prefix = path.rsplit('-', 1)[0]
+    for stale in glob.glob(glob.escape(prefix) + '-*.fs'):
+        if stale != path:
+            _remove(stale)
+
+
+def pruneCache(cache_dir, max_age=MAX_AGE):
+    """Remove the cache files in `cache_dir` not used for `max_age` seconds.
+    """
+    limit = time.time() - max_age
+    for pattern in ('zcml-*.json', 'storage-*.fs'):
+        for path in glob.glob(os.path.join(glob.escape(cache_dir), pattern)):
+            try:
+                stale = os.stat(path).st_mtime < limit
+            except OSError:
+                continue
+            if stale:
+                _remove(path)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        # Removed by a concurrent test run
+        pass
+
+
+def _touch(path):
+    # Mark a cache file as used, so that pruneCache keeps it.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _copyTransactions(source, dest):
+    # Like dest.copyTransactionsFrom(source), but MappingStorage
+    # transaction records lack the extension_bytes that needs.
+    from ZODB.Connection import TransactionMetaData
+    for record in source.iterator():
+        txn = TransactionMetaData(record.user, record.description,
+                                  record.extension)
+        dest.tpc_begin(txn, record.tid, record.status)
+        for r in record:
+            dest.restore(r.oid, r.tid, r.data, '', r.data_txn, txn)
+        dest.tpc_vote(txn)
+        dest.tpc_finish(txn)
+
+
+def saveSnapshot(storage, path):
+    """Copy all transactions of `storage` to a FileStorage at `path`.
+
+    The file is written under a temporary name and moved into place when
+    complete, so concurrent test runs never see a partial snapshot.
+    """
+    from ZODB.FileStorage import FileStorage
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+    try:
+        tmp = os.path.join(tmpdir, 'Data.fs')
+        snapshot = FileStorage(tmp, create=True)
+        try:
+            _copyTransactions(storage, snapshot)
+        finally:
+            snapshot.close()
+        os.replace(tmp, path)
+    finally:
+        for name in os.listdir(tmpdir):
+            os.unlink(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def openSnapshot(path):
+    """Open a snapshot written by `saveSnapshot` read-only, or return None.
+    """
+    from ZODB.FileStorage import FileStorage
+    if not os.path.exists(path):
+        return None
+    _touch(path)
+    return FileStorage(path, read_only=True)
@@ -15,7 +15,14 @@
 
 """
 
+import collections
+import concurrent.futures
 import errno
+import functools
+import hashlib
+import io
+import itertools
+import json
 import optparse
 import os
 import re
@@ -29,6 +36,10 @@ usage = """usage: %prog <options> directory
 Convert an http tcpwatch recorded sesssion to a doctest file, which is
 written to standard output.
 
+With --format=jsonl, every request is written as a line of JSON instead,
+with the status, headers and body hash of the recorded response, to be
+run by zope.app.testing.scenario.ScenarioSuite.
+
 """
 
 parser = optparse.OptionParser(usage)
@@ -36,6 +47,8 @@ parser.add_option("-p", "--prefix", default="watch",
                   help="Prefix for recorded tcpwatch session files")
 parser.add_option("-U", "--skip-url", action="append",
                   help="Regular expression for URLs to skip")
+parser.add_option("-u", "--url", action="append",
+                  help="Regular expression for URLs to include")
 parser.add_option("-E", "--skip-extension", action="append",
                   help="URL file-extension to skip")
 parser.add_option("-e", "--extension", action="append",
@@ -44,9 +57,33 @@ parser.add_option("-I", "--skip-request-header", action="append",
                   help="Request header to skip")
 parser.add_option("-O", "--skip-response-header", action="append",
                   help="Response header to skip")
+parser.add_option("-R", "--rules", action="append",
+                  help="File with further rules, one per line, each an"
+                       " option name without the dashes followed by its"
+                       " value, e.g. 'skip-url ^/@@/'")
 parser.add_option("-r", "--clean-redirects", action="store_true",
                   help="Strip content from redirect responses",
                   default=False)
+parser.add_option("-b", "--max-body", type="int",
+                  help="Replace bodies larger than this many bytes by their"
+                       " length and SHA-256 hash")
+parser.add_option("-f", "--format", type="choice",
+                  choices=["doctest", "jsonl"], default="doctest",
+                  help="Output format: doctest (the default) or jsonl")
+parser.add_option("-j", "--jobs", type="int", default=1,
+                  help="Number of processes converting sessions")
+parser.add_option("-o", "--output-dir",
+                  help="Write the tests of each session to a file of its own"
+                       " in this directory")
+parser.add_option("-d", "--dedupe", action="store_true", default=False,
+                  help="Skip requests and responses identical to ones"
+                       " already output")
+parser.add_option("-s", "--samples", type="int", default=1,
+                  help="With --dedupe, the number of identical requests and"
+                       " responses to output")
+parser.add_option("-g", "--group-by-url", type="int", metavar="DEPTH",
+                  help="With --output-dir, write the tests to one file per"
+                       " URL prefix of DEPTH path segments instead")
 
 default_options = [
     '-e', 'html',
@@ -71,64 +108,318 @@ def dochttp(args=sys.argv[1:], default=None, output_fp=None):
         parser.error("Exactly one argument expected: directory")
 
     directory = args[0]
-
-    skip_extensions = options.skip_extension or ()
-    extensions = [ext for ext in (options.extension or ())
-                  if ext not in skip_extensions]
-    skip_urls = [re.compile(pattern) for pattern in (options.skip_url or ())]
+    try:
+        rules = Rules.fromOptions(options)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    converter = SessionConverter(directory, options, rules)
 
     names = sorted([
         name[:-len(".request")]
         for name in os.listdir(directory)
         if name.startswith(options.prefix) and name.endswith('.request')])
 
-    extre = re.compile(r"[.](\w+)$")
-
-    for name in names:
-        with open(os.path.join(directory, name + ".request"), 'rb') as f:
-            requests = list(Requests(
-                f,
-                options.skip_request_header,
-            ))
-        with open(os.path.join(directory, name + ".response"), 'rb') as f:
-            responses = list(Responses(
-                f,
-                options.skip_response_header,
-            ))
-
-        if len(requests) != len(responses):
-            sys.exit("Expected equal numbers of requests and responses in %r"
-                     % (os.path.join(directory, name + '.*')))
-
-        for request, response in zip(requests, responses):
-            assert (request and response) or not (request or response)
-
-            path = request.path
-            ext = extre.search(path)
-            if ext:
-                ext = ext.group(1)
-
-                if extensions:
-                    if ext not in extensions:
-                        continue
-                else:
-                    if ext in skip_extensions:
-                        continue
-
-            for skip_url in skip_urls:
-                if skip_url.search(request.path):
+    deduplicator = None
+    if options.dedupe:
+        deduplicator = Deduplicator(options.samples)
+    try:
+        if options.output_dir is None and options.jobs <= 1:
+            for name in names:
+                if not converter.convert(name, output_fp, deduplicator):
                     break
+        else:
+            write_outputs(converter.convertAll(names, options.jobs),
+                          options.output_dir, output_fp, deduplicator,
+                          converter.extension)
+    except SessionError as e:
+        sys.exit(str(e))
+    if deduplicator is not None and deduplicator.skipped:
+        print("Skipped %d duplicate requests" % deduplicator.skipped,
+              file=sys.stderr)
+
+
+def fingerprint(request, response):
+    """Return a fingerprint of a request and its response.
+
+    They are normalized by skipping the headers not output and sorting the
+    others, as in the output.
+    """
+    digest = hashlib.sha256()
+    for message in (request, response):
+        for line in message.lines():
+            digest.update(line if isinstance(line, bytes)
+                          else line.encode('latin-1'))
+            digest.update(b'\n')
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class Deduplicator:
+    """Select the first `samples` occurrences of every fingerprint."""
+
+    def __init__(self, samples=1):
+        self.samples = samples
+        self.counts = collections.Counter()
+        self.skipped = 0
+
+    def keep(self, fingerprint):
+        self.counts[fingerprint] += 1
+        if self.counts[fingerprint] > self.samples:
+            self.skipped += 1
+            return False
+        return True
+
+
+class SessionError(Exception):
+    """A recorded session can't be converted or replayed."""
+
+
+def output_name(key, extension='.txt'):
+    """Return the name of the output file for a session or URL group."""
+    return (re.sub(r'[^\w.+-]+', '_', key).strip('_') or 'root') + extension
+
+
+def write_outputs(outputs, output_dir=None, output_fp=None,
+                  deduplicator=None, extension='.txt'):
+    """Write the converted tests, grouped by their output key.
+
+    Without an output directory, all tests are written to `output_fp`.
+    """
+    def tests():
+        for chunks in outputs:
+            for key, digest, text in chunks:
+                if deduplicator is None or deduplicator.keep(digest):
+                    yield key, text
+
+    if output_dir is None:
+        if output_fp is None:
+            output_fp = sys.stdout
+        try:
+            for _key, text in tests():
+                output_fp.write(text)
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        return
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+    try:
+        for key, text in tests():
+            name = output_name(key, extension)
+            if name not in files:
+                files[name] = open(os.path.join(output_dir, name), 'w')
+            files[name].write(text)
+    finally:
+        for f in files.values():
+            f.close()
+
+
+extre = re.compile(r"\w+")
+
+
+class _AnyPattern:
+    # Patterns that can't be merged into a single regular expression.
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(pattern) for pattern in patterns]
+
+    def search(self, string):
+        for pattern in self.patterns:
+            if pattern.search(string):
+                return True
+        return False
+
+
+def merge_patterns(patterns):
+    """Compile regular expressions into one matching any of them.
+
+    Returns None if there are no patterns.
+    """
+    patterns = [re.compile(p) for p in patterns]
+    if not patterns:
+        return None
+    if any(p.groups or p.flags & ~re.UNICODE for p in patterns):
+        # Joining would renumber the groups, changing what backreferences
+        # refer to, or repeat group names, and inline flags, like (?i),
+        # would apply to all patterns or not be allowed after the start of
+        # the merged expression; try them one after another.
+        return _AnyPattern(patterns)
+    return re.compile('|'.join('(?:%s)' % p.pattern for p in patterns))
+
+
+class Rules:
+    """Compiled rules selecting the requests and headers to output."""
+
+    # The options that can be given in rule files.
+    directives = {
+        'extension': 'extension',
+        'skip-extension': 'skip_extension',
+        'url': 'url',
+        'skip-url': 'skip_url',
+        'skip-request-header': 'skip_request_header',
+        'skip-response-header': 'skip_response_header',
+    }
+
+    def __init__(self, extensions=(), skip_extensions=(), urls=(),
+                 skip_urls=(), skip_request_headers=(),
+                 skip_response_headers=()):
+        self.skip_extensions = frozenset(skip_extensions)
+        self.extensions = frozenset(extensions) - self.skip_extensions
+        self.url = merge_patterns(urls)
+        self.skip_url = merge_patterns(skip_urls)
+        self.skip_request_headers = frozenset(
+            name.lower() for name in skip_request_headers)
+        self.skip_response_headers = frozenset(
+            name.lower() for name in skip_response_headers)
+
+    @classmethod
+    def fromOptions(cls, options):
+        values = {dest: list(getattr(options, dest, None) or ())
+                  for dest in cls.directives.values()}
+        for path in getattr(options, 'rules', None) or ():
+            for dest, value in cls.read(path):
+                values[dest].append(value)
+        return cls(values['extension'], values['skip_extension'],
+                   values['url'], values['skip_url'],
+                   values['skip_request_header'],
+                   values['skip_response_header'])
+
+    @classmethod
+    def read(cls, path):
+        """Return the (option, value) pairs in the rule file at `path`."""
+        rules = []
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                directive, _, value = line.partition(' ')
+                if directive not in cls.directives or not value.strip():
+                    raise ValueError("%s, line %d: invalid rule %r"
+                                     % (path, number, line))
+                rules.append((cls.directives[directive], value.strip()))
+        return rules
+
+    def included(self, path):
+        """Return whether the request for `path` is to be output."""
+        _, dot, ext = path.rpartition('.')
+        if dot and extre.fullmatch(ext):
+            if self.extensions:
+                if ext not in self.extensions:
+                    return False
             else:
+                if ext in self.skip_extensions:
+                    return False
+
+        if self.skip_url is not None and self.skip_url.search(path):
+            return False
+        if self.url is not None and not self.url.search(path):
+            return False
+        return True
+
+
+class SessionConverter:
+    """Convert the recorded sessions in a directory to doctests.
+
+    With the jsonl format, they are converted to scenarios instead.
+    """
+
+    def __init__(self, directory, options, rules=None):
+        self.directory = directory
+        self.options = options
+        if rules is None:
+            rules = Rules.fromOptions(options)
+        self.rules = rules
+
+    def exchanges(self, name):
+        """Yield the (request, response) pairs of a session."""
+        options = self.options
+        path = os.path.join(self.directory, name)
+        # Scenarios replay the requests, so their bodies are kept.
+        request_max_body = options.max_body
+        if options.format == 'jsonl':
+            request_max_body = None
+        return read_exchanges(
+            path, self.rules.skip_request_headers,
+            self.rules.skip_response_headers, request_max_body,
+            options.max_body)
+
+    def included(self, request):
+        """Return whether the test for a request is to be output."""
+        return self.rules.included(request.path)
+
+    def convert(self, name, output_fp=None, deduplicator=None):
+        """Write the tests of a session to `output_fp` as they are converted.
+
+        Returns False if the output was closed.
+        """
+        for request, response in self.exchanges(name):
+            if self.included(request):
+                if deduplicator is not None and not deduplicator.keep(
+                        fingerprint(request, response)):
+                    continue
                 try:
-                    output_test(
-                        request,
-                        response,
-                        options.clean_redirects,
-                        output_fp)
+                    self.output(name, request, response, output_fp)
                 except OSError as e:
                     if e.errno == errno.EPIPE:
-                        return
+                        return False
                     raise
+        return True
+
+    @property
+    def extension(self):
+        """The extension of the output files."""
+        if self.options.format == 'jsonl':
+            return '.jsonl'
+        return '.txt'
+
+    def output(self, name, request, response, output_fp):
+        """Write the test for a request of a session in the output format."""
+        if self.options.format == 'jsonl':
+            output_scenario(name, request, response, output_fp)
+        else:
+            output_test(request, response, self.options.clean_redirects,
+                        output_fp)
+
+    def key(self, name, request):
+        # The output a test belongs to: its session, or its URL prefix
+        # when grouping by URL.
+        depth = self.options.group_by_url
+        if not depth:
+            return name
+        path = request.path.split('?')[0]
+        return '/'.join(path.split('/')[1:depth + 1])
+
+    def __call__(self, name):
+        """Return the tests of a session.
+
+        They are returned as a list of (key, fingerprint, text) tuples; the
+        fingerprint is only computed when deduplicating.
+        """
+        chunks = []
+        for request, response in self.exchanges(name):
+            if self.included(request):
+                output = io.StringIO()
+                self.output(name, request, response, output)
+                digest = None
+                if self.options.dedupe:
+                    digest = fingerprint(request, response)
+                chunks.append(
+                    (self.key(name, request), digest, output.getvalue()))
+        return chunks
+
+    def convertAll(self, names, jobs=1):
+        """Convert sessions, in `jobs` processes if more than one.
+
+        Yields the results of calling the converter for every session in
+        the order of `names`.
+        """
+        if jobs <= 1:
+            yield from map(self, names)
+            return
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            yield from executor.map(self, names)
 
 
 def output_test(request, response, clean_redirects=False, output_fp=None):
@@ -136,10 +427,10 @@ def output_test(request, response, clean_redirects=False, output_fp=None):
         output_fp = sys.stdout
     request_lines = [x.decode("latin-1") if not isinstance(x, str) else x
                      for x in request.lines()]
-    print(file=output_fp)
-    print(file=output_fp)
-    print('  >>> print(http(r"""', file=output_fp)
-    print('  ...', '\n  ... '.join(request_lines) + '"""))', file=output_fp)
+    output = [
+        '\n\n  >>> print(http(r"""\n  ... ',
+        '\n  ... '.join(request_lines), '"""))\n',
+    ]
     if response.code in (301, 302, 303) and clean_redirects:
         content_length = None
         if response.headers:
@@ -155,9 +446,33 @@ def output_test(request, response, clean_redirects=False, output_fp=None):
         lines = response.lines()
         lines = [x.decode("latin-1") if not isinstance(x, str) else x
                  for x in lines]
-    print(' ', '\n  '.join([line if line.rstrip() else '<BLANKLINE>'
-                            for line in lines]),
-          file=output_fp)
+    output.extend(('  ', '\n  '.join([line if line.rstrip() else '<BLANKLINE>'
+                                      for line in lines]), '\n'))
+    # Write every test at once.
+    output_fp.write(''.join(output))
+
+
+def output_scenario(session, request, response, output_fp=None):
+    """Write a request and the recorded response as a line of JSON."""
+    if output_fp is None:
+        output_fp = sys.stdout
+    if response.body_sha256 is not None:
+        body_length = response.body_length
+        body_sha256 = response.body_sha256
+    else:
+        body = b'\n'.join(response.body)
+        body_length = len(body)
+        body_sha256 = hashlib.sha256(body).hexdigest()
+    scenario = {
+        'session': session,
+        'request': b'\n'.join(request.lines()).decode('latin-1'),
+        'status': response.code,
+        # Pairs, as headers like Set-Cookie can be repeated
+        'headers': [[name, value] for name, value in response.headers],
+        'body_length': body_length,
+        'body_sha256': body_sha256,
+    }
+    output_fp.write(json.dumps(scenario, sort_keys=True) + '\n')
 
 
 class Message:
@@ -165,7 +480,11 @@ class Message:
     # Always a native string
     start = ''
 
-    def __init__(self, file, skip_headers):
+    # The length and SHA-256 hex digest of the body if it was elided
+    body_length = None
+    body_sha256 = None
+
+    def __init__(self, file, skip_headers, max_body=None):
         start = file.readline().rstrip()
         if start:
             start = start.decode(
@@ -174,24 +493,35 @@ class Message:
             if start.startswith("HTTP/"):
                 # This is a response; extract the response code:
                 self.code = int(start.split()[1])
-            headers = [
-                split_header(header)
-                for header in headers_factory(file).headers
-            ]
-            headers = [
-                ('-'.join([s.capitalize() for s in name.split('-')]),
-                 v.rstrip()
-                 )
-                for (name, v) in headers
-                if name.lower() not in skip_headers
-            ]
+            headers = []
+            for header in headers_factory(file).headers:
+                name, v = split_header(header)
+                if name.lower() not in skip_headers:
+                    headers.append((header_name(name), v.rstrip()))
             self.headers = headers
             content_length = int(dict(headers).get('Content-Length', '0'))
-            if content_length:
+            if max_body is not None and content_length > max_body:
+                self._elide_body(file, content_length)
+            elif content_length:
                 self.body = file.read(content_length).split(b'\n')
             else:
                 self.body = []
 
+    def _elide_body(self, file, length):
+        # Hash the body in chunks instead of keeping it.
+        digest = hashlib.sha256()
+        remaining = length
+        while remaining:
+            chunk = file.read(min(remaining, 65536))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+        self.body_length = length
+        self.body_sha256 = digest.hexdigest()
+        self.body = [('<%d bytes elided, sha256 %s>' % (
+            length, self.body_sha256)).encode('latin-1')]
+
     def __nonzero__(self):
         return bool(self.start)
 
@@ -224,10 +554,16 @@ def split_header(header):
     return headerre.match(header).group(1, 2)
 
 
-def messages(cls, file, skip_headers):
-    skip_headers = [name.lower() for name in (skip_headers or ())]
+@functools.lru_cache(maxsize=1024)
+def header_name(name):
+    """Return the canonical capitalization of a header name."""
+    return '-'.join([s.capitalize() for s in name.split('-')])
+
+
+def messages(cls, file, skip_headers, max_body=None):
+    skip_headers = frozenset(name.lower() for name in (skip_headers or ()))
     while True:
-        message = cls(file, skip_headers)
+        message = cls(file, skip_headers, max_body)
         if message:
             yield message
         else:
@@ -238,18 +574,41 @@ class Request(Message):
 
     path = ''
 
-    def __init__(self, file, skip_headers):
-        Message.__init__(self, file, skip_headers)
+    def __init__(self, file, skip_headers, max_body=None):
+        Message.__init__(self, file, skip_headers, max_body)
         if self.start:
             self.command, self.path, self.protocol = self.start.split()
 
 
-def Requests(file, skip_headers):
-    return messages(Request, file, skip_headers)
+def Requests(file, skip_headers, max_body=None):
+    return messages(Request, file, skip_headers, max_body)
+
+
+def Responses(file, skip_headers, max_body=None):
+    return messages(Message, file, skip_headers, max_body)
+
 
+def read_exchanges(path, skip_request_headers=(), skip_response_headers=(),
+                   request_max_body=None, response_max_body=None):
+    """Yield the (request, response) pairs of the session at `path`.
 
-def Responses(file, skip_headers):
-    return messages(Message, file, skip_headers)
+    `path` is the name of the session's files without the .request and
+    .response extension.
+    """
+    with open(path + ".request", 'rb') as rf, \
+            open(path + ".response", 'rb') as sf:
+        # Read the requests and responses in lockstep, so that only one
+        # of each is held in memory at a time.
+        exchanges = itertools.zip_longest(
+            Requests(rf, skip_request_headers, request_max_body),
+            Responses(sf, skip_response_headers, response_max_body),
+        )
+        for request, response in exchanges:
+            if request is None or response is None:
+                raise SessionError(
+                    "Expected equal numbers of requests and responses"
+                    " in %r" % (path + '.*'))
+            yield request, response
 
 
 main = dochttp
@@ -17,23 +17,40 @@ There should be a file 'ftesting.zcml' in the current directory.
 
 """
 
+import asyncio
+import collections
+import collections.abc
+import concurrent.futures
 import copy
 import doctest
 import io
+import json
 import logging
+import mmap
 import os.path
 import re
+import shutil
 import sys
+import tempfile
+import threading
 import traceback
 import unittest
+import weakref
+from html.parser import HTMLParser
 from http.cookies import SimpleCookie
 
+import transaction
 import zope.app.appsetup.product
 from transaction import abort
 from transaction import commit
 from ZODB.DB import DB
 from ZODB.DemoStorage import DemoStorage
+from ZODB.FileStorage import FileStorage
+from ZODB.FileStorage.FileStorage import FilePool
 from ZODB.interfaces import IDatabase
+from ZODB.MappingStorage import MappingStorage
+from ZODB.utils import load_current
+from ZODB.utils import newTid
 from zope.app.appsetup.appsetup import multi_database
 from zope.app.debug import Debugger
 from zope.app.publication.http import HTTPPublication
@@ -49,13 +66,96 @@ from zope.publisher.skinnable import setDefaultSkin
 from zope.security.interfaces import Forbidden
 from zope.security.interfaces import Unauthorized
 
+import zope.app.testing.cache
 import zope.app.testing.setup
 from zope import component
+from zope.app.testing import timing
 from zope.app.testing._compat import headers_factory
 
 
+_marker = object()
+
+
+class HeaderMap(collections.abc.Mapping):
+    """A case-insensitive mapping of response headers to their values.
+
+    Headers given more than once map to their first value; `getAll`
+    returns all of them.
+    """
+
+    def __init__(self, headers):
+        self._headers = {}
+        for name, value in headers:
+            self._headers.setdefault(name.lower(), (name, []))[1].append(
+                value)
+
+    def __getitem__(self, name):
+        return self._headers[name.lower()][1][0]
+
+    def __iter__(self):
+        return (name for name, _values in self._headers.values())
+
+    def __len__(self):
+        return len(self._headers)
+
+    def __contains__(self, name):
+        return isinstance(name, str) and name.lower() in self._headers
+
+    def getAll(self, name):
+        """Return all values of a header."""
+        if name.lower() not in self._headers:
+            return []
+        return list(self._headers[name.lower()][1])
+
+
+class HTMLIndex(HTMLParser):
+    """The links and forms of an HTML page.
+
+    `links` lists the targets of the anchors in the order of the page, and
+    `forms` a dictionary for every form with its `action`, its `method`
+    and the names of its `fields`.
+    """
+
+    def __init__(self, html=None):
+        super().__init__()
+        self.links = []
+        self.forms = []
+        self._form = None
+        if html is not None:
+            self.feed(html)
+            self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a':
+            if 'href' in attrs:
+                self.links.append(attrs['href'])
+        elif tag == 'form':
+            self._form = {'action': attrs.get('action'),
+                          'method': (attrs.get('method') or 'get').lower(),
+                          'fields': []}
+            self.forms.append(self._form)
+        elif tag in ('input', 'select', 'textarea', 'button'):
+            if self._form is not None and attrs.get('name'):
+                self._form['fields'].append(attrs['name'])
+
+    def handle_endtag(self, tag):
+        if tag == 'form':
+            self._form = None
+
+
 class ResponseWrapper:
-    """A wrapper that adds several introspective methods to a response."""
+    """A wrapper that adds several introspective methods to a response.
+
+    The body is read from the response once, when it is first asked for.
+    Bodies larger than `spool_size` bytes are spooled to a temporary file
+    instead of being kept in memory, and the body is only decoded when it
+    is asked for as text.  The output, the header map, the JSON and the
+    HTML index of a response are computed at most once.
+    """
+
+    # Bodies larger than this many bytes are spooled to a temporary file.
+    spool_size = 1 << 20
 
     def __init__(self, response, path, request, omit=()):
         self._response = response
@@ -63,11 +163,22 @@ class ResponseWrapper:
         self._request = request
         self.omit = omit
         self._body = None
+        # The body, either as a list of byte chunks or as a file
+        self._chunks = None
+        self._file = None
+        # The memoized views: the output with the omitted headers it was
+        # made for, the header map, the JSON and the HTML index
+        self._output = None
+        self._headerMap = None
+        self._json = _marker
+        self._htmlIndex = None
 
     def getOutput(self):
         """Returns the full HTTP output (headers + body)"""
-        body = self.getBody()
         omit = self.omit
+        if self._output is not None and self._output[0] == omit:
+            return self._output[1]
+        body = self.getBody()
         headers = sorted([x
                           for x in self._response.getHeaders()
                           if x[0].lower() not in omit])
@@ -75,33 +186,110 @@ class ResponseWrapper:
         statusline = '{} {}'.format(self._response._request['SERVER_PROTOCOL'],
                                     self._response.getStatusString())
         if body:
-            return f'{statusline}\n{headers}\n\n{body}'
+            output = f'{statusline}\n{headers}\n\n{body}'
+        else:
+            output = f'{statusline}\n{headers}\n'
+        self._output = (omit, output)
+        return output
+
+    def getHeaderMap(self):
+        """Returns a case-insensitive mapping of the response headers"""
+        if self._headerMap is None:
+            self._headerMap = HeaderMap(self._response.getHeaders())
+        return self._headerMap
+
+    def getJSON(self):
+        """Returns the response body parsed as JSON"""
+        if self._json is _marker:
+            self._json = json.loads(self.getBodyBytes())
+        return self._json
+
+    def getHTMLIndex(self):
+        """Returns the links and forms of an HTML response body"""
+        if self._htmlIndex is None:
+            self._htmlIndex = HTMLIndex(self.getBody())
+        return self._htmlIndex
+
+    def _consume(self):
+        # Yield the chunks of the body of the response as bytes.
+        consumeBodyIter = getattr(self._response, 'consumeBodyIter', None)
+        if consumeBodyIter is None:
+            chunks = (self._response.consumeBody(),)
         else:
-            return f'{statusline}\n{headers}\n'
+            chunks = consumeBodyIter() or ()
+        if isinstance(chunks, (str, bytes)):
+            chunks = (chunks,)
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                # Somewhere in the publisher we're getting a DirectResult
+                # whose body is a sequence of strings, but we're expecting
+                # bytes
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+    def _load(self):
+        if self._chunks is not None or self._file is not None:
+            return
+        chunks = []
+        size = 0
+        f = None
+        for chunk in self._consume():
+            if f is not None:
+                f.write(chunk)
+                continue
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.spool_size:
+                f = tempfile.TemporaryFile()
+                f.writelines(chunks)
+                chunks = None
+        if f is None:
+            self._chunks = chunks
+        else:
+            f.flush()
+            self._file = f
+            weakref.finalize(self, f.close)
+
+    def iterBody(self, chunk_size=65536):
+        """Iterate over the response body as chunks of bytes"""
+        self._load()
+        if self._file is None:
+            yield from self._chunks
+            return
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def getBodyBytes(self):
+        """Returns the response body as bytes, without decoding it"""
+        self._load()
+        if self._file is not None:
+            self._file.seek(0)
+            return self._file.read()
+        if len(self._chunks) != 1:
+            self._chunks = [b''.join(self._chunks)]
+        return self._chunks[0]
+
+    def getBodyView(self):
+        """Returns a read-only memoryview of the response body
+
+        A spooled body is mapped into memory instead of being read.
+        """
+        self._load()
+        if self._file is None:
+            return memoryview(self.getBodyBytes())
+        if not os.fstat(self._file.fileno()).st_size:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(self._file.fileno(), 0,
+                                    access=mmap.ACCESS_READ))
 
     def getBody(self):
         """Returns the response body"""
         if self._body is None:
-            try:
-                b = self._response.consumeBody()
-            except TypeError:
-                from zope.publisher.http import DirectResult
-                from zope.publisher.xmlrpc import XMLRPCResponse
-                if (isinstance(self._response, XMLRPCResponse)
-                        and isinstance(
-                            getattr(self._response, '_result', None),
-                            DirectResult)):
-                    # Somewhere in the publisher we're getting a DirectResult
-                    # whose '_result' body is a sequence of strings, but we're
-                    # expecting bytes
-                    b = ''.join(self._response._result.body)
-                else:
-                    raise
-
-            if isinstance(b, bytes) and bytes is not str:
-                b = b.decode("utf-8")
-            self._body = ''.join(b)
-
+            self._body = self.getBodyBytes().decode("utf-8")
         return self._body
 
     def getPath(self):
@@ -127,6 +315,73 @@ class IManagerSetup(zope.interface.Interface):
         """
 
 
+class MemoryStorageFactory:
+    """Storage factory creating in-memory base storages.
+
+    This is the default storage factory of FunctionalTestSetup.
+    """
+
+    def __call__(self, name):
+        return DemoStorage("Memory storage %r" % name)
+
+
+class FileStorageFactory:
+    """Storage factory creating file-backed base storages.
+
+    The data of a file-backed base storage lives in the operating
+    system's page cache rather than on the heap, so worker processes
+    forked after the layer was set up share it instead of each holding a
+    copy, and large fixtures don't have to fit into memory.  Workers must
+    call FunctionalTestSetup.reopenFiles before using the storages;
+    zope.app.testing.parallel does.
+
+    Each storage gets a temporary directory of its own, in `directory` if
+    it is given, that is removed when the storage is closed.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+    def __call__(self, name):
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+        return TemporaryFileStorage(self.directory)
+
+
+class TemporaryFileStorage(FileStorage):
+    """A FileStorage in a temporary directory that is removed on close.
+
+    Only the process that created the storage removes the directory, not
+    the ones forked from it.
+    """
+
+    def __init__(self, directory=None):
+        self._tmpdir = tempfile.mkdtemp('.zope.app.testing', dir=directory)
+        self._pid = os.getpid()
+        FileStorage.__init__(self, os.path.join(self._tmpdir, 'Data.fs'),
+                             create=True)
+
+    def close(self):
+        FileStorage.close(self)
+        if os.getpid() == self._pid:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def _reopenFiles(storage):
+    # Give the FileStorages a storage is based on, which were inherited
+    # through fork(), file handles of their own, so that reading doesn't
+    # move the file offset of the other processes.
+    while storage is not None:
+        if isinstance(storage, FileStorage):
+            files, file = storage._files, storage._file
+            storage._file = open(storage._file_name, 'rb')
+            storage._files = FilePool(storage._file_name)
+            storage._is_read_only = True
+            files.empty()
+            file.close()
+        storage = getattr(storage, 'base', None)
+
+
 class BaseDatabaseFactory:
     """Factory object for passing to appsetup.multi_databases
 
@@ -137,22 +392,34 @@ class BaseDatabaseFactory:
     basic storage(s) containing the data that is common to all tests
     in a layer.
 
-    The constructor takes the name of the new database, and a
-    dictionary of storages.  The 'open' method creates a new
-    DemoStorage, and adds it to the storage dictionary under the given
-    name. Then creates and returns a named DB object using the
-    storage.
+    The constructor takes the name of the new database, a
+    dictionary of storages, optionally a read-only snapshot storage and
+    optionally a storage factory.  The 'open' method creates a new
+    storage, either a DemoStorage on top of the snapshot or by calling
+    the storage factory with the name, and adds it to the storage
+    dictionary under the given name. Then creates and returns a named DB
+    object using the storage.
     """
 
-    def __init__(self, name, base_storages):
+    def __init__(self, name, base_storages, snapshot=None,
+                 storage_factory=None):
         self.name = name
         self.base_storages = base_storages
+        self.snapshot = snapshot
+        if storage_factory is None:
+            storage_factory = MemoryStorageFactory()
+        self.storage_factory = storage_factory
 
     def open(self):
         name = self.name
         if name in self.base_storages:
             raise ValueError("Duplicate database name: %r" % name)
-        storage = DemoStorage("Memory storage %r" % name)
+        if self.snapshot is not None:
+            # Snapshots are file-backed already.
+            storage = DemoStorage("Memory storage %r" % name,
+                                  base=self.snapshot)
+        else:
+            storage = self.storage_factory(name)
         self.base_storages[name] = storage
         return DB(storage, database_name=name)
 
@@ -175,43 +442,321 @@ class DerivedDatabaseFactory:
 
     def __init__(self, name, base_storages):
         self.name = name
+        # The base storage is shared by all tests of the layer.
         self.storage = DemoStorage("Demo storage %r" % name,
-                                   base_storages[name])
+                                   base_storages[name],
+                                   close_base_on_close=False)
 
     def open(self):
         return DB(self.storage, database_name=self.name)
 
 
+class RewindableMappingStorage(MappingStorage):
+    """A MappingStorage whose most recent transactions can be discarded.
+
+    Transaction ids keep increasing across rewinds, so that connections
+    never see time going backwards.
+    """
+
+    def tpc_begin(self, transaction, tid=None):
+        if tid is None:
+            tid = newTid(self._ltid)
+        MappingStorage.tpc_begin(self, transaction, tid)
+
+    def rewind(self, tid):
+        """Discard all transactions committed after `tid`.
+
+        Returns the set of oids whose records were discarded.
+        """
+        oids = set()
+        with self._lock:
+            for discarded in list(self._transactions.keys(tid, None)):
+                if discarded == tid:
+                    continue
+                record = self._transactions.pop(discarded)
+                for oid in record.data:
+                    tid_data = self._data[oid]
+                    del tid_data[discarded]
+                    if not tid_data:
+                        del self._data[oid]
+                    oids.add(oid)
+        return oids
+
+
+class RewindableDemoStorage(DemoStorage):
+    """A DemoStorage whose changes can be reset to a marked state.
+
+    Resetting takes time proportional to the changes made since the mark.
+    Only the objects whose records were discarded are invalidated in the
+    object caches of the database using the storage, so the caches stay
+    warm for everything else.
+    """
+
+    _db = None
+
+    def __init__(self, name, base):
+        DemoStorage.__init__(self, name, base,
+                             changes=RewindableMappingStorage(),
+                             close_base_on_close=False)
+        self.mark()
+
+    def registerDB(self, db):
+        self._db = db
+
+    def mark(self):
+        """Remember the current state as the one to rewind to."""
+        self._mark = self.changes.lastTransaction()
+
+    def rewind(self):
+        """Discard all changes made since the last mark."""
+        oids = self.changes.rewind(self._mark)
+        if oids and self._db is not None:
+            self._db.invalidate(self.changes.lastTransaction(), oids)
+        return oids
+
+
+class CheckpointStorage(DemoStorage):
+    """A frozen copy of the state of a test's DemoStorage.
+
+    It shares the base of the copied storage and holds a copy of its
+    changes, so that later changes to the copied storage don't affect it.
+    Tests derive their storages from it like from a base storage.
+    """
+
+    def __init__(self, name, storage):
+        source = storage.changes
+        changes = MappingStorage()
+        with source._lock:
+            changes._data = {oid: tid_data.__class__(tid_data)
+                             for oid, tid_data in source._data.items()}
+            changes._transactions = source._transactions.__class__(
+                source._transactions)
+            changes._ltid = source._ltid
+            changes._oid = source._oid
+        DemoStorage.__init__(self, name, storage.base, changes=changes,
+                             close_base_on_close=False)
+
+
+class RewindableDatabaseFactory:
+    """Factory object for passing to appsetup.multi_databases
+
+    This class is an internal implementation detail, subject to change
+    without notice!
+
+    It is used by FunctionalTestSetUp.setUp in the 'rewind' isolation
+    mode to create the derived database(s) that are shared by all tests
+    in a layer.
+
+    The constructor takes the name of the new database, a dictionary of
+    base storages and a dictionary of rewindable storages.  The 'open'
+    method creates a new RewindableDemoStorage as a wrapper around the
+    base storage with the given name, and adds it to the rewindable
+    storages under that name. Then creates and returns a named DB object
+    using the storage.
+    """
+
+    def __init__(self, name, base_storages, rewindable_storages):
+        self.name = name
+        self.base_storages = base_storages
+        self.rewindable_storages = rewindable_storages
+
+    def open(self):
+        name = self.name
+        storage = RewindableDemoStorage("Rewindable storage %r" % name,
+                                        self.base_storages[name])
+        self.rewindable_storages[name] = storage
+        return DB(storage, database_name=name)
+
+
+class RecordCachingStorage:
+    """A read-only view of a base storage caching its current records.
+
+    It is shared by the storages derived from the base storage of a layer,
+    so that a record is read from the base storage only once, however
+    many tests load it.  The records are kept in a least recently used
+    cache bounded to `size` bytes of record data.  The cache is emptied
+    when the base storage gets a new transaction.
+
+    This is a read cache of pickles, not of objects: every test still
+    unpickles the objects it loads into its own connection, since their
+    state refers to the other persistent objects of that connection.  It
+    pays off for base storages that are slow to read, like those of
+    FileStorageFactory, where it saved about a fifth of the time of tests
+    loading ten thousand objects; in-memory base storages are as fast to
+    read as the cache.  The 'rewind' isolation mode keeps the unpickled
+    objects of a layer instead.
+
+    The 'hits' and 'misses' attributes count the loads of current records
+    that were or were not served from the cache.
+    """
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = size
+        self.hits = self.misses = 0
+        self._records = collections.OrderedDict()
+        self._bytes = 0
+        self._ltid = base.lastTransaction()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+    def _sync(self):
+        ltid = self.base.lastTransaction()
+        with self._lock:
+            if ltid != self._ltid:
+                self._records.clear()
+                self._bytes = 0
+                self._ltid = ltid
+        return ltid
+
+    def _current(self, oid):
+        self._sync()
+        with self._lock:
+            record = self._records.get(oid)
+            if record is not None:
+                self._records.move_to_end(oid)
+                self.hits += 1
+                return record
+            self.misses += 1
+        data, tid = load_current(self.base, oid)
+        with self._lock:
+            if oid not in self._records and len(data) <= self.size:
+                self._records[oid] = data, tid
+                self._bytes += len(data)
+                while self._bytes > self.size:
+                    _, (old, _) = self._records.popitem(last=False)
+                    self._bytes -= len(old)
+        return data, tid
+
+    def load(self, oid, version=''):
+        return self._current(oid)
+
+    def loadBefore(self, oid, tid):
+        if tid <= self._sync():
+            return self.base.loadBefore(oid, tid)
+        data, serial = self._current(oid)
+        return data, serial, None
+
+    def loadSerial(self, oid, serial):
+        with self._lock:
+            record = self._records.get(oid)
+        if record is not None and record[1] == serial:
+            return record[0]
+        return self.base.loadSerial(oid, serial)
+
+    def statistics(self):
+        """Return a dictionary describing the use of the cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'records': len(self._records), 'bytes': self._bytes}
+
+
+ISOLATION_MODES = ('demostorage', 'rewind')
+
+
 class FunctionalTestSetup:
     """Keeps shared state across several functional test cases."""
 
     __shared_state = {'_init': False}
 
     def __init__(self, config_file=None, database_names=None,
-                 product_config=None):
+                 product_config=None, cache_dir=None, isolation=None,
+                 record_cache_size=None, storage_factory=None, fixtures=()):
         """Initializes Zope 3 framework.
 
         Creates a volatile memory storage.  Parses Zope3 configuration files.
+
+        If `cache_dir` is given, the configuration is executed before the
+        databases are opened, and the committed contents of the base
+        storages are saved to that directory, so that later runs with the
+        same configuration, product configuration and database names
+        don't need to bootstrap them.  The saved contents are used as long
+        as none of the ZCML files and Python modules the configuration was
+        built from change.
+
+        `isolation` selects how tests are isolated from each other.  With
+        'demostorage', the default, every test gets new databases on top
+        of fresh DemoStorages.  With 'rewind', the databases and their
+        IDatabase registrations are kept for the whole layer and the
+        changes made by a test are discarded when it is torn down.
+
+        If `record_cache_size` is given, the records tests load from the
+        base storages are kept in a cache of up to that many bytes that is
+        shared by all tests of the layer; see RecordCachingStorage.
+
+        `storage_factory` is called with the name of each database to
+        create its base storage; see MemoryStorageFactory (the default)
+        and FileStorageFactory.
+
+        `fixtures` is a sequence of callables building the data all tests
+        of the layer need.  They are called once, in order, with the root
+        folder after the databases have been bootstrapped and the manager
+        has been set up, and their changes are committed to the base
+        storages, so that every test sees them without building them
+        again.  When the base storages are loaded from a snapshot, the
+        fixtures are part of it and are not called.
         """
         self.__dict__ = self.__shared_state
 
         if database_names is not None:
             database_names = tuple(database_names)
+        fixtures = tuple(fixtures)
+        if isolation is not None and isolation not in ISOLATION_MODES:
+            raise ValueError(f"Unknown isolation mode: {isolation!r}")
 
         if not self._init:
 
-            # Make sure unit tests are cleaned up
-            zope.app.testing.setup.placefulSetUp()
-            zope.app.testing.setup.placefulTearDown()
-
             if not config_file:
                 config_file = 'ftesting.zcml'
             if database_names is None:
                 database_names = ('unnamed',)
-            self.log = io.StringIO()
-            # Make it silent but keep the log available for debugging
-            logging.root.addHandler(logging.StreamHandler(self.log))
 
+            with timing.timed('init', config_file):
+                self._setUpLayer(config_file, database_names, product_config,
+                                 cache_dir, isolation, record_cache_size,
+                                 storage_factory, fixtures)
+
+            FunctionalTestSetup().connection = None
+
+        elif config_file and config_file != self._config_file:
+            # Running different tests with different configurations is not
+            # supported at the moment
+            raise NotImplementedError('Already configured'
+                                      ' with a different config file')
+
+        elif product_config and product_config != self._product_config:
+            raise NotImplementedError('Already configured'
+                                      ' with different product configuration')
+
+        elif database_names and database_names != self._database_names:
+            # Running different tests with different configurations is not
+            # supported at the moment
+            raise NotImplementedError('Already configured'
+                                      ' with different database names')
+
+        elif isolation and isolation != self._isolation:
+            raise NotImplementedError('Already configured'
+                                      ' with a different isolation mode')
+
+        elif fixtures and fixtures != self._fixtures:
+            raise NotImplementedError('Already configured'
+                                      ' with different fixtures')
+
+    def _setUpLayer(self, config_file, database_names, product_config,
+                    cache_dir, isolation, record_cache_size, storage_factory,
+                    fixtures):
+        # Make sure unit tests are cleaned up
+        with timing.timed('placefulCleanUp', config_file):
+            zope.app.testing.setup.placefulSetUp()
+            zope.app.testing.setup.placefulTearDown()
+
+        self.log = io.StringIO()
+        # Make it silent but keep the log available for debugging
+        logging.root.addHandler(logging.StreamHandler(self.log))
+
+        with timing.timed('productConfiguration', config_file):
             self.old_product_config = copy.deepcopy(
                 zope.app.appsetup.product.saveConfiguration())
             configs = []
@@ -224,44 +769,63 @@ class FunctionalTestSetup:
             self.local_product_config = configs
             zope.app.appsetup.product.setProductConfigurations(configs)
 
-            self._base_storages = {}
+        self._config_file = config_file
+        self._config_digest = None
+        self._fixtures = fixtures
+        snapshots = {}
+        if cache_dir:
+            zope.app.testing.cache.pruneCache(cache_dir)
+            with timing.timed('configuration', config_file):
+                self._config_digest = zope.app.testing.cache.config(
+                    config_file, cache_dir)
+            with timing.timed('openSnapshots', config_file):
+                snapshots = self._openSnapshots(
+                    cache_dir, product_config, database_names)
+
+        self._base_storages = {}
+        with timing.timed('databases', config_file):
             self.db = multi_database(
-                BaseDatabaseFactory(name, self._base_storages)
+                BaseDatabaseFactory(name, self._base_storages,
+                                    snapshots.get(name), storage_factory)
                 for name in database_names)[0][0]
-            # This handles anything added by generations or other bootstrap
-            # subscribers.
+        # This handles anything added by generations or other bootstrap
+        # subscribers.
+        with timing.timed('bootstrapCommit', config_file):
             commit()
-            self.dbstack = []
+        self.dbstack = []
+        # Executes the configuration, unless that was done above, and
+        # bootstraps the databases.
+        with timing.timed('debugger', config_file):
             self.app = Debugger(self.db, config_file)
 
-            self.connection = None
-            self._config_file = config_file
-            self._product_config = product_config
-            self._database_names = database_names
-            self._init = True
-
-            # Make a local grant for the test user
-            setup = component.queryUtility(IManagerSetup)
-            if setup is not None:
+        self.connection = None
+        self._product_config = product_config
+        self._database_names = database_names
+        self._isolation = isolation or 'demostorage'
+        self._rewindable_storages = None
+        self._rewindable_dbs = None
+        self._record_cache_size = record_cache_size
+        self._record_caches = None
+        self._checkpoints = {}
+        self._rewinding = False
+        self._test = None
+        self._init = True
+
+        # Make a local grant for the test user
+        setup = component.queryUtility(IManagerSetup)
+        if setup is not None:
+            with timing.timed('managerSetUp', config_file):
                 setup.setUpManager()
 
-            FunctionalTestSetup().connection = None
-
-        elif config_file and config_file != self._config_file:
-            # Running different tests with different configurations is not
-            # supported at the moment
-            raise NotImplementedError('Already configured'
-                                      ' with a different config file')
+        if not snapshots and self._fixtures:
+            with timing.timed('fixtures', config_file):
+                self._build_fixtures()
 
-        elif product_config and product_config != self._product_config:
-            raise NotImplementedError('Already configured'
-                                      ' with different product configuration')
-
-        elif database_names and database_names != self._database_names:
-            # Running different tests with different configurations is not
-            # supported at the moment
-            raise NotImplementedError('Already configured'
-                                      ' with different database names')
+        if cache_dir and not snapshots:
+            with timing.timed('saveSnapshots', config_file):
+                commit()
+                self._saveSnapshots(
+                    cache_dir, product_config, database_names)
 
     # BBB: Simulate the old base_storage attribute, but only when not using
     # multiple databases. There *is* code in the wild that uses the attribute.
@@ -277,11 +841,50 @@ class FunctionalTestSetup:
 
     base_storage = property(_get_base_storage, _set_base_storage)
 
-    def _close_databases(self):
-        # This is really careful to unregister the databases before attempting
-        # to close anything.  Zope Corporation has a couple of large
-        # multi-database applications that get bitten if we're not careful
-        # like this, but we've not been able to write a concise test case yet.
+    def _snapshotPaths(self, cache_dir, product_config, database_names):
+        if self._config_digest is None:
+            return {}
+        fixtures = [zope.app.testing.cache.fixtureIdentity(fixture)
+                    for fixture in self._fixtures]
+        layer = zope.app.testing.cache.makeKey(
+            os.path.abspath(self._config_file), product_config,
+            database_names, [name for name, digest in fixtures])
+        key = zope.app.testing.cache.makeKey(
+            self._config_digest, zope.app.testing.cache.bootstrapDigest(),
+            product_config, database_names, fixtures)
+        snapshotPath = zope.app.testing.cache.snapshotPath
+        return {name: snapshotPath(cache_dir, layer, key, name)
+                for name in database_names}
+
+    def _openSnapshots(self, cache_dir, product_config, database_names):
+        # Either all databases come from a snapshot or none does.
+        paths = self._snapshotPaths(cache_dir, product_config, database_names)
+        if not paths or not all(map(os.path.exists, paths.values())):
+            return {}
+        return {name: zope.app.testing.cache.openSnapshot(path)
+                for name, path in paths.items()}
+
+    def _saveSnapshots(self, cache_dir, product_config, database_names):
+        paths = self._snapshotPaths(cache_dir, product_config, database_names)
+        for name, path in paths.items():
+            zope.app.testing.cache.saveSnapshot(
+                self._base_storages[name], path)
+            zope.app.testing.cache.pruneSnapshots(path)
+
+    def _build_fixtures(self):
+        for fixture in self._fixtures:
+            connection = self.db.open()
+            try:
+                fixture(connection.root()[ZopePublication.root_name])
+                commit()
+            except BaseException:
+                abort()
+                raise
+            finally:
+                connection.close()
+                setSite(None)
+
+    def _unregister_databases(self):
         base = component.getGlobalSiteManager()
         dbs = []
         for name, db in list(component.getUtilitiesFor(IDatabase)):
@@ -292,39 +895,167 @@ class FunctionalTestSetup:
         if self.connection:
             self.connection.close()
             self.connection = None
-        for db in dbs:
+        return dbs
+
+    def _close_databases(self):
+        # This is really careful to unregister the databases before attempting
+        # to close anything.  Zope Corporation has a couple of large
+        # multi-database applications that get bitten if we're not careful
+        # like this, but we've not been able to write a concise test case yet.
+        for db in self._unregister_databases():
             db.close()
 
-    def setUp(self):
-        """Prepares for a functional test case."""
-        # Tear down the old demo storages (if any) and create fresh ones
+    def _derived_bases(self):
+        # The storages the storages of the tests are derived from.
+        if not self._record_cache_size:
+            return self._base_storages
+        if self._record_caches is None:
+            self._record_caches = {
+                name: RecordCachingStorage(storage, self._record_cache_size)
+                for name, storage in self._base_storages.items()}
+        return self._record_caches
+
+    def getRecordCacheStatistics(self):
+        """Returns the record cache statistics for each database."""
+        return {name: cache.statistics()
+                for name, cache in (self._record_caches or {}).items()}
+
+    def _open_rewindable_databases(self):
+        # The databases and their registrations are kept for the whole
+        # layer.
+        if self._rewindable_dbs is None:
+            self._rewindable_storages = {}
+            self._rewindable_dbs = multi_database(
+                RewindableDatabaseFactory(name, self._derived_bases(),
+                                          self._rewindable_storages)
+                for name in self._database_names)[0]
+        for storage in self._rewindable_storages.values():
+            storage.mark()
+        return self._rewindable_dbs[0]
+
+    def _drop_rewindable_databases(self):
+        for db in self._rewindable_dbs or ():
+            db.close()
+        self._rewindable_dbs = self._rewindable_storages = None
+
+    def _rewind_databases(self):
         abort()
-        self.dbstack.append((self.db, self.connection))
-        self.connection = None
-        zope.app.appsetup.product.setProductConfigurations(
-            self.local_product_config)
-        self.db = self.app.db = multi_database(
-            DerivedDatabaseFactory(name, self._base_storages)
-            for name in self._database_names)[0][0]
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+        for storage in self._rewindable_storages.values():
+            storage.rewind()
+
+    def checkpoint(self, name):
+        """Freezes the committed state of the current test as a checkpoint.
+
+        Later tests of the layer can start from the state by passing the
+        name of the checkpoint to setUp, instead of building it again.
+        Tests started from a checkpoint can make checkpoints of their own,
+        so that the checkpoints form a tree of fixture states.
+        """
+        if not self.dbstack:
+            raise ValueError("Checkpoints can only be made during a test")
+        if name in self._checkpoints:
+            raise ValueError(f"Checkpoint {name!r} already exists")
+        self._checkpoints[name] = {
+            db_name: CheckpointStorage(
+                f"Checkpoint {name!r} of {db_name!r}", db.storage)
+            for db_name, db in self.db.databases.items()}
+
+    def hasCheckpoint(self, name):
+        """Returns whether a checkpoint with the given name exists."""
+        return name in self._checkpoints
+
+    def setUp(self, checkpoint=None, test=None):
+        """Prepares for a functional test case.
+
+        If the name of a `checkpoint` is given, the test starts from the
+        state frozen in it.  The id of the `test` is used to report the
+        time taken by its set up and tear down; see timing.
+        """
+        if checkpoint is not None and checkpoint not in self._checkpoints:
+            raise ValueError(f"Unknown checkpoint: {checkpoint!r}")
+        self._test = test
+        with timing.timed('setUp', self._config_file, test):
+            # Tear down the old demo storages (if any) and create fresh ones
+            abort()
+            self.dbstack.append((self.db, self.connection))
+            self.connection = None
+            zope.app.appsetup.product.setProductConfigurations(
+                self.local_product_config)
+            self._rewinding = (checkpoint is None
+                               and self._isolation == 'rewind')
+            if self._rewinding:
+                self.db = self.app.db = self._open_rewindable_databases()
+            else:
+                if checkpoint is not None:
+                    if self._rewindable_dbs is not None:
+                        # The databases of the checkpoint replace the
+                        # registered rewindable ones.
+                        self._unregister_databases()
+                        self._drop_rewindable_databases()
+                    bases = self._checkpoints[checkpoint]
+                else:
+                    bases = self._derived_bases()
+                self.db = self.app.db = multi_database(
+                    DerivedDatabaseFactory(name, bases)
+                    for name in self._database_names)[0][0]
 
     def tearDown(self):
         """Cleans up after a functional test case."""
-        self._close_databases()
-        self.db, self.connection = self.dbstack.pop()
-        setSite(None)
+        with timing.timed('tearDown', self._config_file, self._test):
+            if self._rewinding:
+                with timing.timed('rewindDatabases', self._config_file,
+                                  self._test):
+                    self._rewind_databases()
+            else:
+                with timing.timed('closeDatabases', self._config_file,
+                                  self._test):
+                    self._close_databases()
+            self.db, self.connection = self.dbstack.pop()
+            setSite(None)
 
     def tearDownCompletely(self):
         """Cleans up the setup done by the constructor."""
-        self._close_databases()
-        assert self.dbstack == []
-        zope.app.testing.setup.placefulTearDown()
-        zope.app.appsetup.product.restoreConfiguration(
-            self.old_product_config)
+        with timing.timed('tearDownCompletely', self._config_file):
+            self._close_databases()
+            self._drop_rewindable_databases()
+            self._record_caches = None
+            for storages in self._checkpoints.values():
+                for storage in storages.values():
+                    storage.close()
+            self._checkpoints = {}
+            # The base databases are no longer registered once a test ran;
+            # make sure snapshot files get closed.
+            for storage in self._base_storages.values():
+                storage.close()
+            assert self.dbstack == []
+            zope.app.testing.setup.placefulTearDown()
+            zope.app.appsetup.product.restoreConfiguration(
+                self.old_product_config)
         self._config_file = False
         self._product_config = None
         self._database_names = None
+        self._isolation = None
+        self._fixtures = ()
         self._init = False
 
+    @classmethod
+    def reopenFiles(cls):
+        """Gives this process its own handles of the base storage files.
+
+        Processes forked after the layer was set up share the file offsets
+        of file-backed base storages, like FileStorageFactory's or base
+        storage snapshots, with their parent, so they must call this
+        before running tests.  The files are opened read-only, as only the
+        parent process may change the base storages.
+        """
+        state = cls.__shared_state
+        if state['_init']:
+            for storage in state['_base_storages'].values():
+                _reopenFiles(storage)
+
     def getRootFolder(self):
         """Returns the Zope root folder."""
         if not self.connection:
@@ -344,16 +1075,25 @@ class ZCMLLayer:
     __bases__ = ()
 
     def __init__(self, config_file, module, name, allow_teardown=False,
-                 product_config=None):
+                 product_config=None, cache_dir=None, isolation=None,
+                 record_cache_size=None, storage_factory=None, fixtures=()):
         self.config_file = config_file
         self.__module__ = module
         self.__name__ = name
         self.allow_teardown = allow_teardown
         self.product_config = product_config
+        self.cache_dir = cache_dir
+        self.isolation = isolation
+        self.record_cache_size = record_cache_size
+        self.storage_factory = storage_factory
+        self.fixtures = tuple(fixtures)
 
     def setUp(self):
         self.setup = FunctionalTestSetup(
-            self.config_file, product_config=self.product_config)
+            self.config_file, product_config=self.product_config,
+            cache_dir=self.cache_dir, isolation=self.isolation,
+            record_cache_size=self.record_cache_size,
+            storage_factory=self.storage_factory, fixtures=self.fixtures)
 
     def tearDown(self):
         self.setup.tearDownCompletely()
@@ -365,10 +1105,12 @@ class ZCMLLayer:
             raise NotImplementedError
 
 
-def defineLayer(name, zcml='test.zcml', allow_teardown=False):
+def defineLayer(name, zcml='test.zcml', allow_teardown=False, fixtures=()):
     """Helper function for defining layers.
 
     Usage: defineLayer('foo')
+
+    `fixtures` are passed on to the layer; see FunctionalTestSetup.
     """
     globals = sys._getframe(1).f_globals
     globals[name] = ZCMLLayer(
@@ -376,6 +1118,7 @@ def defineLayer(name, zcml='test.zcml', allow_teardown=False):
         globals['__name__'],
         name,
         allow_teardown=allow_teardown,
+        fixtures=fixtures,
     )
 
 
@@ -406,10 +1149,15 @@ class FunctionalTestCase(unittest.TestCase):
 
     layer = Functional
 
+    # The name of the checkpoint the tests start from, see
+    # FunctionalTestSetup.checkpoint.
+    checkpoint = None
+
     def setUp(self):
         """Prepares for a functional test case."""
         super().setUp()
-        FunctionalTestSetup().setUp()
+        FunctionalTestSetup().setUp(checkpoint=self.checkpoint,
+                                    test=self.id())
 
     def tearDown(self):
         """Cleans up after a functional test case."""
@@ -506,6 +1254,9 @@ class BrowserTestCase(CookieHandler, FunctionalTestCase):
         Returns the response object enhanced with the following methods:
           getOutput()    -- returns the full HTTP output as a string
           getBody()      -- returns the full response body as a string
+          getBodyBytes() -- returns the full response body as bytes
+          iterBody()     -- iterates over the response body in chunks
+          getBodyView()  -- returns the response body as a memoryview
           getPath()      -- returns the path used in the request
         """
         old_site = self.getSite()
@@ -533,43 +1284,32 @@ class BrowserTestCase(CookieHandler, FunctionalTestCase):
     def checkForBrokenLinks(self, body, path, basic=None):
         """Looks for broken links in a page by trying to traverse relative
         URIs.
+
+        `body` can also be the response returned by `publish`, whose HTML
+        index is then reused.
         """
-        if not body:
-            return
+        if isinstance(body, ResponseWrapper):
+            if not body.getBodyBytes():
+                return
+            index = body.getHTMLIndex()
+        else:
+            if not body:
+                return
+            if not isinstance(body, str):
+                body = body.decode("utf-8")
+            index = HTMLIndex(body)
 
         old_site = self.getSite()
         self.setSite(None)
 
-        from html.parser import HTMLParser
-
-        class SimpleHTMLParser(HTMLParser):
-            def __init__(self, base):
-                super().__init__()
-                self.base = base
-                self.anchorlist = []
-
-            def do_base(self, attrs):
-                self.base = dict(attrs).get('href', self.base)
-
-            def handle_starttag(self, tag, attrs):
-                if tag == 'a':
-                    attrs = dict(attrs)
-                    if 'href' in attrs:
-                        self.anchorlist.append(attrs['href'])
-
-        parser = SimpleHTMLParser(path)
-        if bytes is not str and not isinstance(body, str):
-            body = body.decode("utf-8")
-        parser.feed(body)
-        parser.close()
-        base = parser.base
+        base = path
         while not base.endswith('/'):
             base = base[:-1]
         if base.startswith('http://localhost/'):
             base = base[len('http://localhost/') - 1:]
 
         errors = []
-        for a in parser.anchorlist:
+        for a in index.links:
             if a.startswith('http://localhost/'):
                 a = a[len('http://localhost/') - 1:]
             elif a.find(':') != -1:
@@ -655,6 +1395,9 @@ class HTTPTestCase(FunctionalTestCase):
         Returns the response object enhanced with the following methods:
           getOutput()    -- returns the full HTTP output as a string
           getBody()      -- returns the full response body as a string
+          getBodyBytes() -- returns the full response body as bytes
+          iterBody()     -- iterates over the response body in chunks
+          getBodyView()  -- returns the response body as a memoryview
           getPath()      -- returns the path used in the request
         """
         request = self.makeRequest(path, basic=basic, form=form, env=env,
@@ -728,13 +1471,76 @@ def sample_test_suite():
     return suite
 
 
+def _needsCommit(txn):
+    # Whether committing the transaction would do anything.
+    if txn._resources or txn.isDoomed():
+        return True
+    for name in ('getBeforeCommitHooks', 'getAfterCommitHooks',
+                 'getBeforeAbortHooks', 'getAfterAbortHooks'):
+        hooks = getattr(txn, name, None)
+        if hooks is not None and any(True for hook in hooks()):
+            return True
+    return False
+
+
 class HTTPCaller(CookieHandler):
-    """Execute an HTTP request string via the publisher"""
+    """Execute an HTTP request string via the publisher
+
+    The commit before and the sync after a request are skipped when they
+    would do nothing; `commits_skipped` and `syncs_skipped` count how often
+    that happened.
+    """
+
+    commits_skipped = 0
+    syncs_skipped = 0
+    _synced = None
 
     def __call__(self, request_string, handle_errors=True, form=None):
         # Commit work done by previous python code.
-        commit()
+        self._commit()
+
+        response = self._publish(request_string, handle_errors, form)
+
+        # sync Python connection:
+        self._sync()
+
+        return response
+
+    def batch(self, request_strings, handle_errors=True):
+        """Execute a sequence of HTTP request strings in order.
+
+        Work done by previous python code is committed once before the
+        first request, and the python connection is synced once after the
+        last one.  Cookies set by a response are sent with the following
+        requests.  Returns a list of the responses.
+        """
+        self._commit()
+        responses = [self._publish(request_string, handle_errors)
+                     for request_string in request_strings]
+        self._sync()
+        return responses
+
+    def _commit(self):
+        if _needsCommit(transaction.get()):
+            commit()
+        else:
+            self.commits_skipped += 1
+
+    def _sync(self):
+        # Nothing can have changed for the python connection if no
+        # transaction was committed since it was last synced.
+        connection = getRootFolder()._p_jar
+        state = (connection,
+                 [db.lastTransaction()
+                  for _, db in sorted(connection.db().databases.items())])
+        if (self._synced is not None and self._synced[0] is connection
+                and self._synced[1] == state[1]):
+            self.syncs_skipped += 1
+            return
+        connection.sync()
+        self._synced = state
 
+    def _publish(self, request_string, handle_errors=True, form=None):
         # Discard leading white space to make call layout simpler
         request_string = request_string.lstrip()
 
@@ -765,6 +1571,13 @@ class HTTPCaller(CookieHandler):
                 name = 'HTTP_' + name
             environment[name] = value.rstrip()
 
+        return self._publishEnvironment(method, path, instream, environment,
+                                        handle_errors, form)
+
+    def _publishEnvironment(self, method, path, instream, environment,
+                            handle_errors=True, form=None):
+        # Publish a request whose headers were already parsed into the
+        # environment; `instream` is positioned at the start of the body.
         auth_key = 'HTTP_AUTHORIZATION'
         if auth_key in environment:
             environment[auth_key] = auth_header(environment[auth_key])
@@ -798,10 +1611,6 @@ class HTTPCaller(CookieHandler):
 
         self.saveCookies(response)
         setSite(old_site)
-
-        # sync Python connection:
-        getRootFolder()._p_jar.sync()
-
         return response
 
     def chooseRequestClass(self, method, path, environment):
@@ -810,8 +1619,79 @@ class HTTPCaller(CookieHandler):
         return chooseClasses(method, environment)
 
 
+class AsyncHTTPCaller(HTTPCaller):
+    """Execute HTTP request strings concurrently via the publisher
+
+    Calling it returns a coroutine::
+
+      http = AsyncHTTPCaller(max_workers=4)
+      responses = await asyncio.gather(*[http(request) for ...])
+
+    The requests are published by a pool of up to `max_workers` threads.
+    Each of them has its own transaction manager and opens its own
+    connection to the databases of the current test, so concurrent
+    requests can conflict and be retried like in a real server; `retries`
+    counts how often that happened.  Work done by python code is committed
+    before a request is handed to the pool, and the python connection is
+    synced when its response arrives, both in the calling thread.
+    """
+
+    retries = 0
+
+    def __init__(self, max_workers=4, *args, **kw):
+        super().__init__(*args, **kw)
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    async def __call__(self, request_string, handle_errors=True, form=None):
+        self._commit()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix='AsyncHTTPCaller')
+        response = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._publish, request_string, handle_errors,
+            form)
+        self._sync()
+        return response
+
+    def close(self):
+        """Shut the thread pool down."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def _publishEnvironment(self, method, path, instream, environment,
+                            handle_errors=True, form=None):
+        response = super()._publishEnvironment(
+            method, path, instream, environment, handle_errors, form)
+        retries = getattr(response._request, '_retry_count', 0)
+        if retries:
+            with self._lock:
+                self.retries += retries
+        return response
+
+    def httpCookie(self, path):
+        with self._lock:
+            return super().httpCookie(path)
+
+    def saveCookies(self, response):
+        with self._lock:
+            super().saveCookies(response)
+
+
 def FunctionalDocFileSuite(*paths, **kw):
-    """Build a functional test suite from a text file."""
+    """Build a functional test suite from a text file.
+
+    If the name of a `checkpoint` is given, the tests start from the state
+    frozen in it; see FunctionalTestSetup.checkpoint.
+    """
     kw['package'] = doctest._normalize_module(kw.get('package'))
     _prepare_doctest_keywords(kw)
     suite = doctest.DocFileSuite(*paths, **kw)
@@ -820,7 +1700,11 @@ def FunctionalDocFileSuite(*paths, **kw):
 
 
 def FunctionalDocTestSuite(*paths, **kw):
-    """Build a functional test suite from docstrings in a module."""
+    """Build a functional test suite from docstrings in a module.
+
+    If the name of a `checkpoint` is given, the tests start from the state
+    frozen in it; see FunctionalTestSetup.checkpoint.
+    """
     _prepare_doctest_keywords(kw)
     suite = doctest.DocTestSuite(*paths, **kw)
     suite.layer = Functional
@@ -833,10 +1717,11 @@ def _prepare_doctest_keywords(kw):
     globs['sync'] = sync
 
     kwsetUp = kw.get('setUp')
+    checkpoint = kw.pop('checkpoint', None)
 
     def setUp(test):
         test.globs['http'] = HTTPCaller()
-        FunctionalTestSetup().setUp()
+        FunctionalTestSetup().setUp(checkpoint=checkpoint, test=test.name)
         if kwsetUp is not None:
             kwsetUp(test)
     kw['setUp'] = setUp
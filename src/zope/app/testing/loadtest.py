@@ -0,0 +1,235 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Drive a functional layer with requests from several threads
+
+The requests are given as templates in the raw HTTP format HTTPCaller
+takes.  ``$n`` in a template is replaced by the sequence number of the
+request and ``$worker`` by the number of the thread sending it.  Every
+thread keeps its own cookies, like a browser session would.
+
+"""
+
+import importlib
+import itertools
+import json
+import math
+import optparse
+import string
+import sys
+import threading
+import time
+
+from zope.app.testing.functional import FunctionalTestSetup
+from zope.app.testing.functional import HTTPCaller
+
+
+usage = """usage: %prog <options> layer template...
+
+Run the requests in the template files against the functional layer given
+by its dotted name, e.g. zope.app.testing.testing.AppTestingLayer, and
+print a report of the latencies, throughput and errors.
+
+"""
+
+parser = optparse.OptionParser(usage)
+parser.add_option("-w", "--workers", type="int", default=4,
+                  help="Number of threads sending requests")
+parser.add_option("-d", "--duration", type="float",
+                  help="Number of seconds to run for")
+parser.add_option("-n", "--requests", type="int",
+                  help="Number of requests to send")
+parser.add_option("-j", "--json", action="store_true", default=False,
+                  help="Print the report as JSON")
+
+
+def percentile(values, p):
+    """Return the `p` percentile of the sorted `values` (nearest rank)."""
+    if not values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+class LoadTestReport:
+    """The outcome of a load test."""
+
+    def __init__(self, latencies, errors, retries, elapsed, statuses):
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.retries = retries
+        self.elapsed = elapsed
+        self.statuses = statuses
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        """Requests per second."""
+        if not self.elapsed:
+            return 0.0
+        return self.requests / self.elapsed
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+    def asDict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'statuses': {str(status): count
+                         for status, count in self.statuses.items()},
+        }
+
+    def __str__(self):
+        lines = [
+            'Requests:    %d in %.2f s (%.1f/s)' % (
+                self.requests, self.elapsed, self.throughput),
+            'Errors:      %d' % self.errors,
+            'Retries:     %d' % self.retries,
+        ]
+        if self.latencies:
+            lines.append('Latency (ms): p50 %.2f  p95 %.2f  p99 %.2f' % tuple(
+                self.percentile(p) * 1000 for p in (50, 95, 99)))
+        lines.append('Statuses:    ' + ', '.join(
+            '%s: %d' % item
+            for item in sorted(self.statuses.items(), key=str)))
+        return '\n'.join(lines)
+
+
+def _worker(number, templates, sequence, lock, deadline, handle_errors,
+            results):
+    http = HTTPCaller()
+    latencies = []
+    errors = retries = 0
+    statuses = {}
+    while deadline is None or time.perf_counter() < deadline:
+        with lock:
+            n = next(sequence, None)
+        if n is None:
+            break
+        request_string = templates[n % len(templates)].safe_substitute(
+            n=n, worker=number)
+        start = time.perf_counter()
+        try:
+            response = http._publish(request_string, handle_errors)
+        except Exception:
+            status = 'exception'
+        else:
+            status = response.getStatus()
+            retries += getattr(response._request, '_retry_count', 0)
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        if status == 'exception' or status >= 500:
+            errors += 1
+    results.append((latencies, errors, retries, statuses))
+
+
+def loadtest(layer, templates, workers=4, duration=None, requests=None,
+             handle_errors=True):
+    """Send requests made from `templates` to `layer` from `workers` threads.
+
+    It stops after `duration` seconds or `requests` requests, whichever
+    comes first; at least one of them must be given.  The layer is set up
+    if necessary and left set up.  The requests run in a functional test
+    of their own, so their changes are discarded afterwards.
+
+    Returns a LoadTestReport.  Responses with a status of 500 or above
+    count as errors; the conflict errors that were retried are counted
+    separately.
+    """
+    if duration is None and requests is None:
+        raise ValueError("Either a duration or a number of requests"
+                         " is required")
+    if not templates:
+        raise ValueError("No request templates")
+    templates = [string.Template(template.lstrip())
+                 for template in templates]
+
+    layer.setUp()
+    setup = FunctionalTestSetup()
+    setup.setUp(test='loadtest')
+    try:
+        sequence = itertools.count()
+        if requests is not None:
+            sequence = iter(range(requests))
+        lock = threading.Lock()
+        results = []
+        start = time.perf_counter()
+        deadline = None if duration is None else start + duration
+        threads = [
+            threading.Thread(
+                target=_worker, name='loadtest-%d' % number,
+                args=(number, templates, sequence, lock, deadline,
+                      handle_errors, results))
+            for number in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        setup.tearDown()
+
+    statuses = {}
+    for _latencies, _errors, _retries, worker_statuses in results:
+        for status, count in worker_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    return LoadTestReport(
+        [latency for result in results for latency in result[0]],
+        sum(result[1] for result in results),
+        sum(result[2] for result in results),
+        elapsed, statuses)
+
+
+def resolve(dotted_name):
+    module, name = dotted_name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def main(args=None, output_fp=None):
+    """Run a load test from the command line."""
+    if args is None:
+        args = sys.argv[1:]
+    if output_fp is None:
+        output_fp = sys.stdout
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error("A layer and at least one template are required")
+    if options.duration is None and options.requests is None:
+        parser.error("Either --duration or --requests is required")
+
+    templates = []
+    for path in args[1:]:
+        with open(path) as f:
+            templates.append(f.read())
+    report = loadtest(resolve(args[0]), templates, options.workers,
+                      options.duration, options.requests)
+    if options.json:
+        json.dump(report.asDict(), output_fp, indent=2, sort_keys=True)
+        print(file=output_fp)
+    else:
+        print(report, file=output_fp)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Run the tests of a functional layer in forked worker processes.
+
+The layer is set up once in the parent process.  Because
+FunctionalTestSetup keeps the configuration and the base storages in
+memory, the forked workers share them copy-on-write; every test only
+pushes its own DemoStorage on top.  File-backed base storages are
+reopened read-only in every worker, so that the workers don't share file
+offsets.  Workers take the next test from a shared counter and send their
+results back to the parent, which reports them, in the original order, to
+the test result.
+
+Test runners only accept suites of tests from a test_suite function, and
+run the tests of every suite one by one, so a ForkedSuite must be wrapped
+in a suite of its own::
+
+  def test_suite():
+      return unittest.TestSuite([
+          ForkedSuite(unittest.defaultTestLoader.loadTestsFromName(
+              __name__), workers=4),
+      ])
+
+"""
+
+import multiprocessing
+import os
+import pickle
+import sys
+import unittest
+
+from zope.app.testing.functional import FunctionalTestSetup
+
+
+class WorkerError(Exception):
+    """An error or failure reported by a worker process.
+
+    The argument is the formatted traceback from the worker.
+    """
+
+    def __str__(self):
+        return self.args[0]
+
+
+def _flatten(tests):
+    if isinstance(tests, unittest.TestSuite):
+        for test in tests:
+            yield from _flatten(test)
+    else:
+        yield tests
+
+
+def _outcomes(result):
+    # Turn the result of running a single test into picklable outcomes.
+    outcomes = []
+    for kind, items in (('error', result.errors),
+                        ('failure', result.failures),
+                        ('skip', result.skipped),
+                        ('expectedFailure', result.expectedFailures)):
+        for _test, text in items:
+            outcomes.append((kind, text))
+    for _test in result.unexpectedSuccesses:
+        outcomes.append(('unexpectedSuccess', None))
+    return outcomes
+
+
+def _runWorker(tests, counter):
+    outcomes = {}
+    while True:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        if index >= len(tests):
+            return outcomes
+        result = unittest.TestResult()
+        tests[index](result)
+        outcomes[index] = _outcomes(result)
+
+
+def _report(test, outcomes, result):
+    result.startTest(test)
+    if outcomes is None:
+        outcomes = [('error', 'The worker process running this test died.')]
+    for kind, text in outcomes:
+        err = (WorkerError, WorkerError(text), None)
+        if kind == 'error':
+            result.addError(test, err)
+        elif kind == 'failure':
+            result.addFailure(test, err)
+        elif kind == 'skip':
+            result.addSkip(test, text)
+        elif kind == 'expectedFailure':
+            result.addExpectedFailure(test, err)
+        else:
+            result.addUnexpectedSuccess(test)
+    if not outcomes:
+        result.addSuccess(test)
+    result.stopTest(test)
+
+
+def runForked(tests, result, workers=2):
+    """Run `tests` in `workers` processes forked from this one.
+
+    The layer of the tests must already be set up.  Results are reported
+    to `result` once all workers are done.  Where forking isn't possible,
+    or not worth it, the tests are run in this process.
+    """
+    tests = list(_flatten(tests))
+    workers = min(workers, len(tests))
+    if workers < 2 or not hasattr(os, 'fork'):
+        for test in tests:
+            test(result)
+        return result
+
+    counter = multiprocessing.get_context('fork').Value('l', 0)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    children = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover (runs in the child)
+            os.close(read)
+            status = 1
+            try:
+                FunctionalTestSetup.reopenFiles()
+                outcomes = _runWorker(tests, counter)
+                with os.fdopen(write, 'wb') as f:
+                    pickle.dump(outcomes, f, pickle.HIGHEST_PROTOCOL)
+                status = 0
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        os.close(write)
+        children.append((pid, read))
+
+    outcomes = {}
+    for pid, read in children:
+        with os.fdopen(read, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        if data:
+            outcomes.update(pickle.loads(data))
+
+    for index, test in enumerate(tests):
+        _report(test, outcomes.get(index), result)
+    return result
+
+
+class ForkedSuite:
+    """A group of tests that runs in forked worker processes.
+
+    It takes the layer of the wrapped tests, so that test runners set the
+    layer up once, in the parent process, before the workers are forked.
+    It is not a TestSuite, which test runners would run test by test, so
+    it has to be wrapped in one to be returned from test_suite.
+    """
+
+    def __init__(self, tests, workers=2, layer=None):
+        self._tests = tests
+        self.workers = workers
+        if layer is None:
+            layer = getattr(tests, 'layer', None)
+        if layer is not None:
+            self.layer = layer
+
+    def id(self):
+        return '{}.{}({})'.format(
+            __name__, self.__class__.__name__,
+            ', '.join(test.id() for test in _flatten(self._tests)))
+
+    def __str__(self):
+        return 'forked tests (%d workers)' % self.workers
+
+    def countTestCases(self):
+        return self._tests.countTestCases()
+
+    def run(self, result):
+        return runForked(self._tests, result, self.workers)
+
+    __call__ = run
@@ -0,0 +1,184 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replay tcpwatch recorded sessions against a functional layer
+
+Every recorded request is published through HTTPCaller, the status code
+is compared with the one of the recorded response and the time taken is
+reported per URL, so recorded sessions can serve as repeatable
+performance benchmarks.
+
+"""
+
+import json
+import optparse
+import os
+import sys
+import time
+
+from zope.app.testing.dochttp import SessionError
+from zope.app.testing.dochttp import read_exchanges
+from zope.app.testing.functional import FunctionalTestSetup
+from zope.app.testing.functional import HTTPCaller
+from zope.app.testing.loadtest import percentile
+from zope.app.testing.loadtest import resolve
+
+
+usage = """usage: %prog <options> layer directory
+
+Replay the tcpwatch recorded sessions in the directory against the
+functional layer given by its dotted name and print the time taken per URL
+and the requests whose status differs from the recorded one.
+
+"""
+
+parser = optparse.OptionParser(usage)
+parser.add_option("-p", "--prefix", default="watch",
+                  help="Prefix for recorded tcpwatch session files")
+parser.add_option("-r", "--repeat", type="int", default=1,
+                  help="Number of times to replay the sessions")
+parser.add_option("-j", "--json", action="store_true", default=False,
+                  help="Print the report as JSON")
+
+
+def sessions(directory, prefix='watch'):
+    """Return the names of the recorded sessions in `directory`."""
+    return sorted(
+        name[:-len(".request")]
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith('.request'))
+
+
+def exchanges(directory, name):
+    """Yield the recorded (request, response) pairs of a session.
+
+    Raises SessionError if the numbers of requests and responses differ.
+    """
+    return read_exchanges(os.path.join(directory, name))
+
+
+def request_string(request):
+    """Return a recorded request in the format HTTPCaller takes."""
+    return b'\n'.join(request.lines()).decode('latin-1')
+
+
+class ReplayReport:
+    """The outcome of replaying recorded sessions."""
+
+    def __init__(self):
+        self.timings = {}
+        self.mismatches = []
+
+    def add(self, session, path, expected, actual, duration):
+        self.timings.setdefault(path, []).append(duration)
+        if expected != actual:
+            self.mismatches.append((session, path, expected, actual))
+
+    @property
+    def requests(self):
+        return sum(len(durations) for durations in self.timings.values())
+
+    def statistics(self):
+        """Return statistics of the time taken per URL.
+
+        The URLs taking the most time in total come first.
+        """
+        stats = []
+        for path, durations in self.timings.items():
+            durations = sorted(durations)
+            stats.append({
+                'path': path,
+                'count': len(durations),
+                'total': sum(durations),
+                'mean': sum(durations) / len(durations),
+                'p50': percentile(durations, 50),
+                'max': durations[-1],
+            })
+        stats.sort(key=lambda s: (-s['total'], s['path']))
+        return stats
+
+    def asDict(self):
+        return {
+            'requests': self.requests,
+            'urls': self.statistics(),
+            'mismatches': [
+                {'session': session, 'path': path,
+                 'expected': expected, 'actual': actual}
+                for session, path, expected, actual in self.mismatches],
+        }
+
+    def __str__(self):
+        lines = ['%8s %10s %10s %10s  %s' % (
+            'count', 'total ms', 'mean ms', 'max ms', 'URL')]
+        for s in self.statistics():
+            lines.append('%8d %10.2f %10.2f %10.2f  %s' % (
+                s['count'], s['total'] * 1000, s['mean'] * 1000,
+                s['max'] * 1000, s['path']))
+        for session, path, expected, actual in self.mismatches:
+            lines.append(
+                f'{session}: {path} returned {actual} instead of {expected}')
+        return '\n'.join(lines)
+
+
+def replay(layer, directory, prefix='watch', repeat=1, handle_errors=True):
+    """Replay the sessions recorded in `directory` against `layer`.
+
+    Every replay of a session runs in a functional test of its own and
+    with cookies of its own.  The layer is set up if necessary and left
+    set up.  Returns a ReplayReport.
+    """
+    layer.setUp()
+    setup = FunctionalTestSetup()
+    report = ReplayReport()
+    for _ in range(repeat):
+        for name in sessions(directory, prefix):
+            setup.setUp(test=name)
+            try:
+                http = HTTPCaller()
+                for request, response in exchanges(directory, name):
+                    data = request_string(request)
+                    start = time.perf_counter()
+                    result = http(data, handle_errors=handle_errors)
+                    duration = time.perf_counter() - start
+                    report.add(name, request.path, response.code,
+                               result.getStatus(), duration)
+            finally:
+                setup.tearDown()
+    return report
+
+
+def main(args=None, output_fp=None):
+    """Replay recorded sessions from the command line."""
+    if args is None:
+        args = sys.argv[1:]
+    if output_fp is None:
+        output_fp = sys.stdout
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error("Exactly two arguments expected: layer directory")
+
+    try:
+        report = replay(resolve(args[0]), args[1], options.prefix,
+                        options.repeat)
+    except SessionError as e:
+        sys.exit(str(e))
+    if options.json:
+        json.dump(report.asDict(), output_fp, indent=2, sort_keys=True)
+        print(file=output_fp)
+    else:
+        print(report, file=output_fp)
+    return report
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main().mismatches else 0)
@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Run the scenarios written by ``dochttp --format=jsonl`` as tests
+
+Every line of a scenario file is a JSON object with the request of a
+recorded session and the status, headers and body hash of the recorded
+response.  The requests of a session run in a functional test of their
+own through HTTPCaller, and the responses are compared with the recorded
+ones directly instead of parsing and diffing doctest output::
+
+  def test_suite():
+      return ScenarioSuite('recorded.jsonl')
+
+"""
+
+import doctest
+import hashlib
+import json
+import os
+import unittest
+
+from zope.app.testing.functional import Functional
+from zope.app.testing.functional import FunctionalTestCase
+from zope.app.testing.functional import HTTPCaller
+
+
+# The response headers compared by default.  Others, like Location, often
+# depend on the host the session was recorded with.
+default_headers = ('Content-Type',)
+
+
+class ScenarioTestCase(FunctionalTestCase):
+    """The requests of a recorded session.
+
+    Only the position of the session in the scenario file is kept; its
+    requests are read when the test runs.
+    """
+
+    def __init__(self, path, session, offset, count, headers=default_headers,
+                 body=True, layer=None):
+        super().__init__()
+        if layer is not None:
+            self.layer = layer
+        self.path = path
+        self.session = session
+        self.offset = offset
+        self.count = count
+        self.headers = tuple(headers)
+        self.body = body
+
+    def id(self):
+        return f'{self.path}:{self.session}'
+
+    def __str__(self):
+        return f'{self.session} ({os.path.basename(self.path)})'
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.id()}>'
+
+    def scenarios(self):
+        """Return the requests of the session and their responses."""
+        scenarios = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while len(scenarios) < self.count:
+                line = f.readline()
+                if line.strip():
+                    scenarios.append(json.loads(line))
+        return scenarios
+
+    def compare(self, scenario, response):
+        """Return the differences between a response and the recorded one."""
+        differences = []
+        status = response.getStatus()
+        if status != scenario['status']:
+            differences.append(f"status {status} != {scenario['status']}")
+        headers = response.getHeaders()
+        for name in self.headers:
+            values = header_values(headers, name)
+            recorded = header_values(scenario['headers'], name)
+            if values != recorded:
+                differences.append(f'{name} {values!r} != {recorded!r}')
+        if self.body:
+            digest = hashlib.sha256()
+            length = 0
+            for chunk in response.iterBody():
+                digest.update(chunk)
+                length += len(chunk)
+            if digest.hexdigest() != scenario['body_sha256']:
+                differences.append('body of {} bytes != recorded {}'.format(
+                    length, scenario['body_length']))
+        return differences
+
+    def runTest(self):
+        http = HTTPCaller()
+        failures = []
+        for scenario in self.scenarios():
+            response = http(scenario['request'])
+            differences = self.compare(scenario, response)
+            if differences:
+                failures.append('{}: {}'.format(
+                    scenario['request'].split('\n', 1)[0],
+                    ', '.join(differences)))
+        if failures:
+            self.fail('\n'.join(failures))
+
+
+def header_values(headers, name):
+    """Return the values of the header `name` in (name, value) pairs."""
+    name = name.lower()
+    return [value for key, value in headers if key.lower() == name]
+
+
+def scan(path):
+    """Yield the session, offset and number of lines of every session.
+
+    The lines of a session are consecutive.
+    """
+    session = start = None
+    count = 0
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                name = json.loads(line)['session']
+                if name != session:
+                    if count:
+                        yield session, start, count
+                    session, start, count = name, offset, 0
+                count += 1
+            offset += len(line)
+    if count:
+        yield session, start, count
+
+
+def ScenarioSuite(*paths, **kw):
+    """Build a functional test suite from scenario files.
+
+    Relative paths are relative to the calling module or `package`.  The
+    `headers` compared and whether to compare the `body` can be given, as
+    well as the `layer`.
+    """
+    package = doctest._normalize_module(kw.get('package'))
+    headers = kw.get('headers', default_headers)
+    body = kw.get('body', True)
+    layer = kw.get('layer', Functional)
+    suite = unittest.TestSuite()
+    for path in paths:
+        if not os.path.isabs(path):
+            path = doctest._module_relative_path(package, path)
+        for session, offset, count in scan(path):
+            suite.addTest(ScenarioTestCase(
+                path, session, offset, count, headers, body, layer))
+    suite.layer = layer
+    return suite
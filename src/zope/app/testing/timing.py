@@ -0,0 +1,151 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Timing of the phases of functional layer and test set up.
+
+FunctionalTestSetup measures the phases of setting up and tearing down
+its layer and its tests and notifies an IPhaseTimedEvent for each of
+them.  A PhaseRecorder collects these events and exports them as JSON,
+e.g. to track the set up overhead of a test suite over time::
+
+  recorder = PhaseRecorder()
+  recorder.start()
+  ...  # run the tests
+  recorder.stop()
+  recorder.dump('timing.json')
+
+"""
+
+import atexit
+import contextlib
+import json
+import time
+
+import zope.event
+import zope.interface
+import zope.schema
+
+
+# Bump this whenever the layout of the exported data changes.
+FORMAT_VERSION = 1
+
+
+class IPhaseTimedEvent(zope.interface.Interface):
+    """A phase of setting up or tearing down a layer or test finished."""
+
+    phase = zope.schema.TextLine(title="The name of the phase")
+
+    duration = zope.schema.Float(title="The duration in seconds")
+
+    layer = zope.schema.TextLine(
+        title="The configuration file of the layer",
+        required=False)
+
+    test = zope.schema.TextLine(
+        title="The id of the test, for test phases",
+        required=False)
+
+
+@zope.interface.implementer(IPhaseTimedEvent)
+class PhaseTimed:
+
+    def __init__(self, phase, duration, layer=None, test=None):
+        self.phase = phase
+        self.duration = duration
+        self.layer = layer
+        self.test = test
+
+    def __repr__(self):
+        return '<{} {} {:.6f}s layer={!r} test={!r}>'.format(
+            self.__class__.__name__, self.phase, self.duration,
+            self.layer, self.test)
+
+
+@contextlib.contextmanager
+def timed(phase, layer=None, test=None):
+    """Time the enclosed block and notify a PhaseTimed event for it."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        zope.event.notify(
+            PhaseTimed(phase, time.perf_counter() - start, layer, test))
+
+
+class PhaseRecorder:
+    """Collects the PhaseTimed events notified while it is started."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, event):
+        if IPhaseTimedEvent.providedBy(event):
+            self.records.append(
+                (event.layer, event.test, event.phase, event.duration))
+
+    def start(self):
+        if self not in zope.event.subscribers:
+            zope.event.subscribers.append(self)
+
+    def stop(self):
+        if self in zope.event.subscribers:
+            zope.event.subscribers.remove(self)
+
+    def clear(self):
+        del self.records[:]
+
+    def summary(self):
+        """Return the count, total and maximum duration of each phase.
+
+        The result maps the layer to a mapping from the phase name to
+        the statistics, summed up over all tests.
+        """
+        summary = {}
+        for layer, _test, phase, duration in self.records:
+            stats = summary.setdefault(layer, {}).setdefault(
+                phase, {'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+        return summary
+
+    def asDict(self):
+        """Return the recorded data as a JSON-serializable dictionary."""
+        return {
+            'version': FORMAT_VERSION,
+            'records': [
+                {'layer': layer, 'test': test, 'phase': phase,
+                 'duration': duration}
+                for layer, test, phase, duration in self.records],
+            'summary': [
+                dict(stats, layer=layer, phase=phase)
+                for layer, phases in self.summary().items()
+                for phase, stats in phases.items()],
+        }
+
+    def dump(self, path):
+        """Write the recorded data as JSON to the file at `path`."""
+        with open(path, 'w') as f:
+            json.dump(self.asDict(), f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def recordTo(path):
+    """Record the phases until the process exits, then write them to `path`.
+
+    Returns the started recorder.
+    """
+    recorder = PhaseRecorder()
+    recorder.start()
+    atexit.register(recorder.dump, path)
+    return recorder